@@ -6,7 +6,13 @@
 #
 
 
+import csv
 import datetime
+import functools
+import io
+import os
+import re
+from operator import attrgetter
 from beancount.core.number import D
 from beancount.core import data
 from beancount.core import amount
@@ -15,6 +21,24 @@ from beancount.ingest import importer
 from beancount import loader
 
 
+TWO_PLACES = D('0.01')
+
+#translation tables for convert_value() and convert_value2()
+VALUE_TABLE = str.maketrans({'.': None, ',': '.', '"': None})
+VALUE2_TABLE = str.maketrans({'.': None, ',': '.'})
+
+#header lines of the supported file formats
+FILE_FORMAT_HEADERS = (
+    (1, '"Buchungstag";"Valuta";"Auftraggeber/Zahlungsempfänger";"Empfänger/Zahlungspflichtiger";"Konto-Nr.";"IBAN";"BLZ";"BIC";"Vorgang/Verwendungszweck";"Kundenreferenz";"Währung";"Umsatz";" "'),
+    (2, "Buchungstag;Valuta;Textschlüssel;Primanota;Zahlungsempfänger;ZahlungsempfängerKto;ZahlungsempfängerIBAN;ZahlungsempfängerBLZ;ZahlungsempfängerBIC;Vorgang/Verwendungszweck;Kundenreferenz;Währung;Umsatz;Soll/Haben"),
+    (3, "Bezeichnung Auftragskonto;IBAN Auftragskonto;BIC Auftragskonto;Bankname Auftragskonto;Buchungstag;Valutadatum;Name Zahlungsbeteiligter;IBAN Zahlungsbeteiligter;BIC (SWIFT-Code) Zahlungsbeteiligter;Buchungstext;Verwendungszweck;Betrag;Waehrung;Saldo nach Buchung;Bemerkung;Kategorie;Steuerrelevant;Glaeubiger ID;Mandatsreferenz"),
+    )
+#a single pattern which matches any of the headers, the matching group identifies the file format
+FILE_FORMAT_PATTERN = re.compile('|'.join('(%s)' % re.escape(header) for version, header in FILE_FORMAT_HEADERS))
+
+#transactions of the target journals, see load_transactions()
+JOURNAL_CACHE = dict()
+
 
 class VolksbankImporter(importer.ImporterProtocol):
     '''An importer for CSV export from a Volksbank online banking.'''
@@ -38,22 +62,53 @@ class VolksbankImporter(importer.ImporterProtocol):
         self.file_format_version = None
         
     def initialize_guessing(self):
-        '''Create a dictionary of the previous transactions in 'target_journal', which can be used to guess the right postings for the new transactions.'''
+        '''Create a dictionary with the postings of the most recent previous transaction for each payee in 'target_journal', which can be used to guess the right postings for the new transactions.'''
         self.posting_dict = dict()
+        self.posting_template = dict()
         if not (self.target_journal is None):
-            entries,errors,options = loader.load_file(self.target_journal)
-            entries = [e for e in entries if isinstance(e, data.Transaction)]
-            entries = sorted(entries, key = lambda e: e.date)
+            entries = load_transactions(self.target_journal)
             for entry in entries:
-                if not (self.account in [p.account for p in entry.postings]):
+                if not any(p.account == self.account for p in entry.postings):
                     continue
                 if entry.payee is None:
                     continue
                 if len(entry.payee) == 0:
                     continue
-                if not entry.payee in self.posting_dict:
-                    self.posting_dict[entry.payee] = []
-                self.posting_dict[entry.payee].append(entry.postings)
+                #entries are sorted by date, so the most recent transaction is stored last
+                self.posting_dict[entry.payee] = entry.postings
+            for payee in self.posting_dict:
+                template = self.create_posting_template(self.posting_dict[payee])
+                if not (template is None):
+                    self.posting_template[payee] = template
+
+    def create_posting_template(self, previous_postings):
+        '''Extract the accounts and the shares of the total transaction value from the postings of a previous transaction, such that guess_postings() does not need to walk through the previous postings again for every new transaction.
+        The posting of the importing_account is moved to the end of the lists.
+        Returns a tuple (accounts, shares, reference_value), where reference_value is the previous value of the importing_account, or None if the previous transaction has no positive postings.
+        
+        Parameters
+        ----------
+        previous_postings:          list of postings
+        '''
+        s = sum([p.units.number for p in previous_postings if p.units.number > 0])
+        if s == 0:
+            return None
+        accounts = []
+        shares = []
+        #without a posting of the importing_account, the signs are never reversed
+        reference_value = 0
+        own_index = None
+        for prev_posting in previous_postings:
+            if prev_posting.account == self.account:
+                reference_value = prev_posting.units.number
+                own_index = len(accounts)
+            accounts.append(prev_posting.account)
+            shares.append(prev_posting.units.number / s)
+        #move importing_account to the end of the list
+        if not (own_index is None):
+            accounts.append(accounts.pop(own_index))
+            shares.append(shares.pop(own_index))
+        return accounts, shares, reference_value
 
     def guess_postings(self, payee, total_transaction_value):
         '''Guess postings based on the previous transactions with the same payee.
@@ -63,53 +118,35 @@ class VolksbankImporter(importer.ImporterProtocol):
         Parameters
         ----------
         payee:                      string
-        total_transaction_value:    float
+        total_transaction_value:    Decimal
         '''
         new_postings = []
-        if payee in self.posting_dict:
-            previous_postings = self.posting_dict[payee][-1]
-            accounts = []
-            units = []
-            for prev_posting in previous_postings:
-                accounts.append(prev_posting.account)
-                units.append(prev_posting.units)
-                if prev_posting.account == self.account:
-                    prev_posting_had_reversed_signs = 0 > float(prev_posting.units.number) * total_transaction_value
-            s = sum([float(u.number) for u in units if u.number > 0])
-            for account,unit in zip(accounts,units):
-                share = float(unit.number) / s
-                if prev_posting_had_reversed_signs:
-                    share = -share
-                p = data.Posting(account, amount.Amount(D(str(round(share*abs(total_transaction_value),2))), self.currency), None, None, None, None)
-                new_postings.append(p)
-            #move importing_account to the end of the list
-            i = 0
-            for j,posting in enumerate(new_postings):
-                if posting.account == self.account:
-                    i = j
-            new_postings.append(new_postings.pop(i))
+        if payee in self.posting_template:
+            accounts, shares, reference_value = self.posting_template[payee]
+            #the previous transaction went in the other direction (e.g. a refund)
+            if 0 > reference_value * total_transaction_value:
+                shares = [-share for share in shares]
+            #local names for the list comprehension to avoid attribute lookups for every posting
+            Posting = data.Posting
+            Amount = amount.Amount
+            currency = self.currency
+            absolute_value = abs(total_transaction_value)
+            new_postings = [Posting(account, Amount((share*absolute_value).quantize(TWO_PLACES), currency), None, None, None, None) for account,share in zip(accounts,shares)]
         else:
-            new_postings.append(data.Posting(self.default_adjacent_account, amount.Amount(D(str(-total_transaction_value)), self.currency), None, None, None, None))
-            new_postings.append(data.Posting(self.account, amount.Amount(D(str(total_transaction_value)), self.currency), None, None, None, None))
+            new_postings.append(data.Posting(self.default_adjacent_account, amount.Amount(-total_transaction_value, self.currency), None, None, None, None))
+            new_postings.append(data.Posting(self.account, amount.Amount(total_transaction_value, self.currency), None, None, None, None))
         return new_postings
         
     def identify(self, file):
-        header_version1 = '"Buchungstag";"Valuta";"Auftraggeber/Zahlungsempfänger";"Empfänger/Zahlungspflichtiger";"Konto-Nr.";"IBAN";"BLZ";"BIC";"Vorgang/Verwendungszweck";"Kundenreferenz";"Währung";"Umsatz";" "'
-        header_version2 = "Buchungstag;Valuta;Textschlüssel;Primanota;Zahlungsempfänger;ZahlungsempfängerKto;ZahlungsempfängerIBAN;ZahlungsempfängerBLZ;ZahlungsempfängerBIC;Vorgang/Verwendungszweck;Kundenreferenz;Währung;Umsatz;Soll/Haben"
-        header_version3 = "Bezeichnung Auftragskonto;IBAN Auftragskonto;BIC Auftragskonto;Bankname Auftragskonto;Buchungstag;Valutadatum;Name Zahlungsbeteiligter;IBAN Zahlungsbeteiligter;BIC (SWIFT-Code) Zahlungsbeteiligter;Buchungstext;Verwendungszweck;Betrag;Waehrung;Saldo nach Buchung;Bemerkung;Kategorie;Steuerrelevant;Glaeubiger ID;Mandatsreferenz"
+        #the header is always at the beginning of the file, so there is no need to read the whole file
         with open(file.name, "r", encoding = "ISO-8859-1") as f:
-            for line in f:
-                if header_version1 in line:
-                    self.file_format_version = 1
-                    return True
-                elif header_version2 in line:
-                    self.file_format_version = 2
-                    return True
-                elif header_version3 in line:
-                    self.file_format_version = 3
-                    return True
+            head = f.read(4096)
+        match = FILE_FORMAT_PATTERN.search(head)
+        if match is None:
             print('Unable to identify file format.')
             return False
+        self.file_format_version = FILE_FORMAT_HEADERS[match.lastindex - 1][0]
+        return True
 
     def file_account(self, file):
         return self.account
@@ -117,27 +154,56 @@ class VolksbankImporter(importer.ImporterProtocol):
     def extract(self, file):
         #parse csv file
         if self.file_format_version == 1:
-            buchungstag, auftraggeber_empfaenger, buchungstext, verwendungszweck, betrag, kontostand, indices, endsaldo = parse_csv_file_v1(file.name)
+            rows = ParsedRows(parse_csv_file_v1(file.name))
         elif self.file_format_version == 2:
-            buchungstag, auftraggeber_empfaenger, buchungstext, verwendungszweck, betrag, kontostand, indices, endsaldo = parse_csv_file_v2(file.name)
+            rows = ParsedRows(parse_csv_file_v2(file.name))
         elif self.file_format_version == 3:
-            buchungstag, auftraggeber_empfaenger, buchungstext, verwendungszweck, betrag, kontostand, indices, endsaldo = parse_csv_file_v3(file.name)
+            rows = ParsedRows(parse_csv_file_v3(file.name))
         else:
             raise IOError("Unknown file format.")
-        #create transactions
+        #create transactions, with local names for the functions used in the loop
+        guess_postings = self.guess_postings
+        new_metadata = data.new_metadata
+        Transaction = data.Transaction
+        EMPTY_SET = data.EMPTY_SET
+        flag = self.flag
+        filename = file.name
         entries = []
-        for i in range(len(buchungstag)):
-            postings = self.guess_postings(auftraggeber_empfaenger[i], float(betrag[i]) ) 
-            meta = data.new_metadata(file.name, indices[i])
-            txn = data.Transaction(meta, buchungstag[i], self.flag, auftraggeber_empfaenger[i], verwendungszweck[i], data.EMPTY_SET, data.EMPTY_SET, postings)
+        for buchungstag, auftraggeber_empfaenger, buchungstext, verwendungszweck, betrag, kontostand, linenumber in rows:
+            postings = guess_postings(auftraggeber_empfaenger, betrag) 
+            meta = new_metadata(filename, linenumber)
+            txn = Transaction(meta, buchungstag, flag, auftraggeber_empfaenger, verwendungszweck, EMPTY_SET, EMPTY_SET, postings)
             entries.append(txn)
         #create balance
+        endsaldo = rows.endsaldo
         meta = data.new_metadata(file.name, endsaldo[2])
-        entries.append( data.Balance(meta, endsaldo[0] + datetime.timedelta(days=1), self.account, amount.Amount(D(endsaldo[1]), self.currency), None, None) )
+        entries.append( data.Balance(meta, endsaldo[0] + datetime.timedelta(days=1), self.account, amount.Amount(endsaldo[1], self.currency), None, None) )
         
         return entries
 
 
+def load_transactions(filename):
+    '''Load the transactions from a beancount journal, sorted by date.
+    The result is cached together with the modification time of the file, so if several importers use the same target journal, it is only parsed once.
+    If the file does not exist, the loader reports the error and the (empty) result is not cached.
+    
+    Parameters
+    ----------
+    filename:   string
+    '''
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        mtime = None
+    if not (mtime is None) and filename in JOURNAL_CACHE and JOURNAL_CACHE[filename][0] == mtime:
+        return JOURNAL_CACHE[filename][1]
+    entries,errors,options = loader.load_file(filename)
+    entries = [e for e in entries if isinstance(e, data.Transaction)]
+    entries.sort(key = attrgetter('date'))
+    if not (mtime is None):
+        JOURNAL_CACHE[filename] = (mtime, entries)
+    return entries
+
 def convert_value(value, soll_haben):
     '''Convert number format from the CSV file and add sign +/- depending on Soll/Haben (Credit/Debit).
     Example:  convert_value('1.200,30', 'S') returns '-1200.30'.
@@ -147,7 +213,7 @@ def convert_value(value, soll_haben):
     value:      string, number with ',' as decimal separator and '.' as thousand-separator
     soll_haben: string, 'S' for 'Soll' and 'H' for 'Haben'
     '''
-    return ('-' if ('S' in soll_haben) else '') + value.replace('.','').replace(',','.').replace('"','')
+    return ('-' if ('S' in soll_haben) else '') + value.translate(VALUE_TABLE)
 
 def convert_value2(value):
     '''Convert signed numbers from the CSV file. For unsigned number with Soll/Haben see convert_value().
@@ -156,163 +222,130 @@ def convert_value2(value):
     ----------
     value:     string, like '-4,7' or '5,21'
     '''
-    return value.replace('.','').replace(',','.')
+    return value.translate(VALUE2_TABLE)
 
+@functools.lru_cache(maxsize = 1024)
 def convert_date(date):
     '''Convert date from the CSV file (format '04.10.2020') to datetime.
+    The results are cached, because there are usually several transactions on the same day.
     
     Parameters
     ----------
     date:       string
     '''
-    day,month,year = date.replace('"','').split('.')
+    day,month,year = date.strip('"').split('.', 2)
     return datetime.date(int(year),int(month),int(day))
 
 
+def read_csv_rows(filename, header_keyword, quoting = csv.QUOTE_MINIMAL):
+    '''Read the CSV file at once and yield the rows after the header line together with their line numbers.
+    A transaction may be splitted over several lines, in this case the line number is the one of the last line.
+    
+    Parameters
+    ----------
+    filename:       string
+    header_keyword: string, a keyword which identifies the header line
+    quoting:        optional. csv.QUOTE_NONE for file formats without quoted fields, where '"' is part of the text
+    '''
+    with open(filename, 'r', encoding = 'iso-8859-1') as f:
+        content = f.read()
+    #the rows start after the line containing the header keyword
+    keyword_position = content.find(header_keyword)
+    if keyword_position < 0:
+        return
+    start = content.find('\n', keyword_position) + 1
+    if start == 0:
+        return
+    header_index = content.count('\n', 0, start) - 1
+    #StringIO only splits lines on '\n', unlike str.splitlines()
+    reader = csv.reader(io.StringIO(content[start:]), delimiter = ';', quotechar = '"', quoting = quoting)
+    for values in reader:
+        yield header_index + reader.line_num, values
+
+class ParsedRows:
+    '''Iterate over the transactions of one of the parse_csv_file functions and keep the endsaldo it returns.'''
+
+    def __init__(self, rows):
+        '''
+        Parameters
+        ----------
+        rows:       generator returned by parse_csv_file_v1(), parse_csv_file_v2() or parse_csv_file_v3()
+        '''
+        self.rows = rows
+        self.endsaldo = None
+
+    def __iter__(self):
+        self.endsaldo = yield from self.rows
+
 def parse_csv_file_v1(filename):
     '''Parse CSV file.
+    Yields a tuple (buchungstag, auftraggeber_empfaenger, buchungstext, verwendungszweck, betrag, kontostand, linenumber) for each transaction and returns the tuple endsaldo = (date, amount, linenumber). Amounts are converted to Decimal.
     
     Parameters
     ----------
     filename:   string
     '''
-    buchungstag = []
-    auftraggeber_empfaenger = []
-    buchungstext = []
-    verwendungszweck = []
-    betrag = []
-    kontostand = []
     endsaldo = None
     
-    linenumbers = []
-    header = True
-    collector = ""
-    linenumber = -1
-    
-    f = open(filename, 'r', encoding = 'iso-8859-1')
-    for line in f:
-        linenumber += 1
-        #skip header
-        if header:
-            if "Valuta" in line:
-                header = False  
+    for linenumber, values in read_csv_rows(filename, "Valuta"):
+        #skip empty lines and everything which is not a transaction or balance
+        if len(values) == 0 or not values[-1] in ('S', 'H'):
             continue
-        #skip empty lines
-        if len(line) == 0:
-            continue
-        #Each transaction in the csv file is splitted over several lines, so we have to collect the content of several lines until the transaction is complete: 
-        collector = collector + line.replace('\n',' ')
-        if '"S"' in collector or '"H"' in collector:
-            if "Anfangssaldo" in collector:
-                pass
-            elif "Endsaldo" in collector:
-                result = collector.split(';')
-                date = result[0]
-                amount = convert_value(result[11], result[12].replace('"',''))
-                endsaldo = (convert_date(date),amount, linenumber)
-            else:
-                values = collector.split(';')
-                buchungstag.append(convert_date(values[0]))
-                auftraggeber_empfaenger.append(values[3].replace('"',''))
-                buchungstext.append('')
-                verwendungszweck.append(values[8].replace('"',''))
-                betrag.append(convert_value(values[11], collector[-3:]))
-                kontostand.append(None)
-                linenumbers.append(linenumber)
-            collector = ""
+        if "Anfangssaldo" in values:
+            pass
+        elif "Endsaldo" in values:
+            date = values[0]
+            amount = D(convert_value(values[11], values[12]))
+            endsaldo = (convert_date(date),amount, linenumber)
+        else:
+            #fields may be splitted over several lines
+            yield convert_date(values[0]), values[3].replace('\n', ' '), '', values[8].replace('\n', ' '), D(convert_value(values[11], values[12])), None, linenumber
             
-    return buchungstag, auftraggeber_empfaenger, buchungstext, verwendungszweck, betrag, kontostand, linenumbers, endsaldo
+    return endsaldo
 
 def parse_csv_file_v2(filename):
     '''Parse CSV file with the new file format they started to use at the beginning of 2022.
+    Yields and returns the same as parse_csv_file_v1().
     
     Parameters
     ----------
     filename:   string
     '''
-    buchungstag = []
-    auftraggeber_empfaenger = []
-    buchungstext = []
-    verwendungszweck = []
-    betrag = []
-    kontostand = []
     endsaldo = None
     
-    linenumbers = []
-    header = True
-    collector = ""
-    linenumber = -1
-    
-    f = open(filename, 'r', encoding = 'iso-8859-1')
-    for line in f:
-        linenumber += 1
-        #skip header
-        if header:
-            if "Valuta" in line:
-                header = False  
-            continue
-        
-        values = line.split(';')
-        if len(values[0]) == 0:
+    for linenumber, values in read_csv_rows(filename, "Valuta", quoting = csv.QUOTE_NONE):
+        if len(values) == 0 or len(values[0]) == 0:
             continue
         if values[10] == 'Endsaldo':
             date = convert_date(values[0])
-            amount = convert_value(values[12], values[13])
+            amount = D(convert_value(values[12], values[13]))
             endsaldo = (date, amount, linenumber)
         elif values[10] == 'Anfangssaldo':
             continue
         else:
-            buchungstag.append(convert_date(values[0]))
-            auftraggeber_empfaenger.append(values[4])
-            buchungstext.append('')
-            verwendungszweck.append(values[9])
-            betrag.append(convert_value(values[12], values[13]))
-            kontostand.append(None)
-            linenumbers.append(linenumber)
-            
-    return buchungstag, auftraggeber_empfaenger, buchungstext, verwendungszweck, betrag, kontostand, linenumbers, endsaldo
+            yield convert_date(values[0]), values[4], '', values[9], D(convert_value(values[12], values[13])), None, linenumber
+        
+    return endsaldo
 
 def parse_csv_file_v3(filename):
     '''Parse CSV file with the new file format they started to use at the beginning of 2022.
+    Yields and returns the same as parse_csv_file_v1().
     
     Parameters
     ----------
     filename:   string
     '''
-    buchungstag = []
-    auftraggeber_empfaenger = []
-    buchungstext = []
-    verwendungszweck = []
-    betrag = []
-    kontostand = []
     endsaldo = None
     
-    linenumbers = []
-    header = True
-    collector = ""
-    linenumber = -1
-    
-    f = open(filename, 'r', encoding = 'iso-8859-1')
-    for line in f:
-        linenumber += 1
-        #skip header
-        if header:
-            if "Mandatsreferenz" in line:
-                header = False  
-            continue
-        
-        values = line.split(';')
-        if len(values[0]) == 0:
+    for linenumber, values in read_csv_rows(filename, "Mandatsreferenz", quoting = csv.QUOTE_NONE):
+        if len(values) == 0 or len(values[0]) == 0:
             continue
         
-        buchungstag.append(convert_date(values[4]))
-        auftraggeber_empfaenger.append(values[6])
-        buchungstext.append('')
-        verwendungszweck.append(values[10])
-        betrag.append(convert_value2(values[11]))
-        kontostand.append(convert_value2(values[13]))
-        linenumbers.append(linenumber)
-        
-    endsaldo = (buchungstag[0], kontostand[0], linenumbers[0])
+        buchungstag = convert_date(values[4])
+        kontostand = D(convert_value2(values[13]))
+        #the most recent transaction comes first, its balance is the final balance
+        if endsaldo is None:
+            endsaldo = (buchungstag, kontostand, linenumber)
+        yield buchungstag, values[6], '', values[10], D(convert_value2(values[11])), kontostand, linenumber
             
-    return buchungstag, auftraggeber_empfaenger, buchungstext, verwendungszweck, betrag, kontostand, linenumbers, endsaldo
+    return endsaldo